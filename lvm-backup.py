@@ -3,196 +3,413 @@
 import sys
 import logging
 import argparse
-import yaml
+import asyncio
 import subprocess
+import shutil
 import os
+import time
+import copy
+import json
+from collections import OrderedDict
 
 RESTIC = "restic"
 LVS = "lvs"
+UDEVADM = "udevadm"
 
 config = []
 
+log = logging.getLogger("lvm-backup")
+
+MIB = 1024 * 1024
+PROGRESS_INTERVAL = 60
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+YAML_CACHE_SIZE = 100
+_YAML_CACHE = OrderedDict()
+JSON_CACHE_SUFFIX = ".cache.json"
+JSON_CACHE_VERSION = 1
+
 class BackupException(Exception):
     pass
 
 class Config:
     def __init__(self, configFile, prune):
-        with open(configFile, 'r') as stream:
-            configYaml = yaml.safe_load(stream)
-            self.mounts_dir = configYaml["mounts_dir"]
-            self.target_vg = configYaml["TargetVG"]
-            self.target_lv = configYaml["TargetLV"]
-            self.password = configYaml["password"]
-            self.hourlySnapshots = configYaml.get("hourlySnapshots")
-            self.dailySnapshots = configYaml.get("dailySnapshots")
-            self.weeklySnapshots = configYaml.get("weeklySnapshots")
-            self.monthlySnapshots = configYaml.get("monthlySnapshots")
-            self.yearlySnapshots = configYaml.get("yearlySnapshots")
-            self.prune = prune
-            self.sources = []
-            for vg in configYaml["VGs"]:
-                for lv in vg["LVs"]:
-                    self.sources.append(Source(vg["name"], lv["name"], lv.get("options")))
+        configYaml = _load_yaml_cached(configFile)
+        self.mounts_dir = configYaml["mounts_dir"]
+        self.target_vg = configYaml["TargetVG"]
+        self.target_lv = configYaml["TargetLV"]
+        self.password = configYaml["password"]
+        self.hourlySnapshots = configYaml.get("hourlySnapshots")
+        self.dailySnapshots = configYaml.get("dailySnapshots")
+        self.weeklySnapshots = configYaml.get("weeklySnapshots")
+        self.monthlySnapshots = configYaml.get("monthlySnapshots")
+        self.yearlySnapshots = configYaml.get("yearlySnapshots")
+        self.prune = prune
+        self._lv_set = _scan_lvs()
+        self.sources = []
+        for vg in configYaml["VGs"]:
+            for lv in vg["LVs"]:
+                self.sources.append(Source(vg["name"], lv["name"], lv.get("options"), lv.get("repo")))
+        self.max_parallel = configYaml.get("max_parallel", max(1, min(4, len(self.sources))))
+        if not isinstance(self.max_parallel, int) or isinstance(self.max_parallel, bool) or self.max_parallel < 1:
+            raise BackupException("max_parallel must be a positive integer, got %r" % self.max_parallel)
 
 
     def get_sources(self):
         return self.sources
 
+    def lv_exists(self, vg, lv):
+        return (vg, lv) in self._lv_set
+
+    def lv_created(self, vg, lv):
+        self._lv_set.add((vg, lv))
+
+    def lv_removed(self, vg, lv):
+        self._lv_set.discard((vg, lv))
+
+def _scan_lvs():
+    try:
+        p = subprocess.run([LVS, "--reportformat", "json", "-o", "vg_name,lv_name"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    except FileNotFoundError:
+        return set()
+    if p.returncode != 0:
+        log.warning("Could not list logical volumes: %s" % p.stderr.decode())
+        return set()
+    lvs = set()
+    for report in json.loads(p.stdout.decode())["report"]:
+        for lv in report.get("lv", []):
+            lvs.add((lv["vg_name"], lv["lv_name"]))
+    return lvs
+
+def _load_yaml_cached(configFile):
+    # the in-process cache only hits when a Config is built more than once per process (the CLI
+    # builds one), so the JSON sidecar is what saves parsing across runs
+    st = os.stat(configFile)
+    cached = _YAML_CACHE.get(configFile)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        _YAML_CACHE.move_to_end(configFile)
+        return copy.deepcopy(cached[2])
+    parsed = _load_json_cache(configFile, st)
+    if parsed is None:
+        # PyYAML is only needed when the JSON cache is stale or missing
+        import yaml
+        try:
+            from yaml import CSafeLoader as Loader
+        except ImportError:
+            from yaml import SafeLoader as Loader
+        with open(configFile, 'r') as stream:
+            parsed = yaml.load(stream, Loader=Loader)
+        _write_json_cache(configFile, st, parsed)
+    _YAML_CACHE[configFile] = (st.st_mtime_ns, st.st_size, parsed)
+    _YAML_CACHE.move_to_end(configFile)
+    while len(_YAML_CACHE) > YAML_CACHE_SIZE:
+        _YAML_CACHE.popitem(last=False)
+    return copy.deepcopy(parsed)
+
+def _load_json_cache(configFile, st):
+    cacheFile = configFile + JSON_CACHE_SUFFIX
+    try:
+        with open(cacheFile, 'r') as stream:
+            cached = json.load(stream)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("version") != JSON_CACHE_VERSION:
+        return None
+    # an exact match catches configs restored with an older mtime, which a newer-than check would miss
+    if cached.get("mtime_ns") != st.st_mtime_ns or cached.get("size") != st.st_size:
+        return None
+    log.debug("Using cached config %s" % cacheFile)
+    return cached.get("config")
+
+def _write_json_cache(configFile, st, parsed):
+    # the config holds the restic password, so keep the cache private to the owner
+    cacheFile = configFile + JSON_CACHE_SUFFIX
+    tmpFile = cacheFile + ".tmp"
+    try:
+        fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # the mode above only applies on creation, a leftover tmp file keeps its old permissions
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as stream:
+            json.dump({"version": JSON_CACHE_VERSION, "mtime_ns": st.st_mtime_ns, "size": st.st_size,
+                "config": parsed}, stream)
+        os.replace(tmpFile, cacheFile)
+    except (OSError, TypeError, ValueError) as e:
+        log.debug("Could not write config cache %s: %s" % (cacheFile, e))
+        try:
+            os.remove(tmpFile)
+        except OSError:
+            pass
+
 class Source:
-    def __init__(self, vg, lv, options):
+    __slots__ = ("volume", "options", "repo")
+
+    def __init__(self, vg, lv, options, repo=None):
         self.volume = LVolume(vg, lv)
-        if not options: 
-            self.options = []
-        else:
-            self.options = options
-        self.check_exists()
+        self.options = tuple(options) if options else ()
+        self.repo = repo
 
-    def check_exists(self):
-        return self.volume.exists()
+class Repository:
+    __slots__ = ("volume",)
+
+    def __init__(self):
+        self.volume = LVolume(config.target_vg, config.target_lv)
+
+    def repo_path(self, source):
+        # a per-source repo is a path inside the target volume (or absolute), so sources need not share a repo lock
+        if source and source.repo:
+            return os.path.join(self.volume.to_mount_dir(), source.repo)
+        return self.volume.to_mount_dir()
+
+    def repo_paths(self):
+        # only repos some source backs up into; the main repo is skipped when every source has its own
+        paths = []
+        for source in config.sources or [None]:
+            path = self.repo_path(source)
+            if path not in paths:
+                paths.append(path)
+        return paths
+
+    async def open(self):
+        if self.volume.is_mounted():
+            await self.volume.umount()
+        await self.volume.mount(ro=False)
+        for path in self.repo_paths():
+            if await runCommandRetVal(RESTIC, "-r", path, "snapshots", env=restic_env()) != 0:
+                await self.close()
+                raise BackupException("Restic repository %s not properly initialized." % path)
+
+    async def close(self):
+        await self.volume.umount()
+        await self.volume.mount(ro=True)
 
 class Backup:
-    def __init__ (self, source, snapshot):
+    __slots__ = ("source", "snapshot", "volume", "repo")
+
+    def __init__ (self, source, snapshot, repository):
         self.source = source
         self.snapshot = snapshot
-        self.volume = LVolume(config.target_vg, config.target_lv)
-        if self.volume.is_mounted():
-            self.volume.umount()
-        self.volume.mount(ro=False)
-        if not runCommandRetVal("RESTIC_PASSWORD='%s' restic -r %s snapshots" % (config.password, self.volume.to_mount_dir()) ):
-            BackupException("Restic repository %s not properly initialized." % dir)
+        self.volume = repository.volume
+        self.repo = repository.repo_path(source)
 
-    def backup(self):
-        logging.info("\nbackup STARTED (%s)" % self.snapshot.volume.lv)
+    async def backup(self):
+        log.info("\nbackup STARTED (%s)" % self.snapshot.volume.lv)
         if "raw" in self.source.options:
             source_volume = LVolume(self.snapshot.volume.vg, self.snapshot.volume.lv, raw=True)
         else:
             source_volume = self.snapshot.volume
-        source_volume.mount()
+        await source_volume.mount()
         try: 
-            self.__run_backup()
+            await self.__run_backup()
         finally:
-            source_volume.umount()
-        logging.info("\nbackup COMPLETED (%s)" % self.snapshot.volume.lv)
-
-    def __run_backup(self):
-        runCommand("RESTIC_PASSWORD='%s' restic -r %s backup %s" % 
-            (config.password, self.volume.to_mount_dir(), self.snapshot.volume.to_mount_dir()), 
-            printOutput=True )
+            await source_volume.umount()
+        log.info("\nbackup COMPLETED (%s)" % self.snapshot.volume.lv)
 
-    def close(self):
-        self.volume.umount()
-        self.volume.mount(ro=True)
+    async def __run_backup(self):
+        await runCommand(RESTIC, "-r", self.repo, "backup", "--json", self.snapshot.volume.to_mount_dir(),
+            env={**restic_env(), "RESTIC_PROGRESS_FPS": str(1 / PROGRESS_INTERVAL)},
+            handleOutput=ResticProgress(self.snapshot.volume.lv))
 
-    def cleanup(self):
-        keep = ""
+    async def cleanup(self):
+        keep = []
         if config.hourlySnapshots:
-            keep += f"--keep-hourly {config.hourlySnapshots} "
+            keep += ["--keep-hourly", str(config.hourlySnapshots)]
         if config.dailySnapshots:
-            keep += f"--keep-daily {config.dailySnapshots} "
+            keep += ["--keep-daily", str(config.dailySnapshots)]
         if config.weeklySnapshots:
-            keep += f"--keep-weekly {config.weeklySnapshots} "
+            keep += ["--keep-weekly", str(config.weeklySnapshots)]
         if config.monthlySnapshots:
-            keep += f"--keep-monthly {config.monthlySnapshots} "
+            keep += ["--keep-monthly", str(config.monthlySnapshots)]
         if config.prune:
-            keep += "--prune"
-        runCommand("RESTIC_PASSWORD='%s' restic -r %s forget %s" % (config.password, self.volume.to_mount_dir(), keep), printOutput=True)
+            keep += ["--prune"]
+        await runCommand(RESTIC, "-r", self.repo, "forget", *keep, printOutput=True, env=restic_env())
     
 class Snapshot:
+    __slots__ = ("source", "snapshot_lv", "volume")
+
     def __init__(self, source):
         self.source = source
         self.snapshot_lv = source.volume.lv + "_snapshot"
         self.volume = LVolume(source.volume.vg, self.snapshot_lv, source.options)
 
-    def create(self):
+    async def create(self):
         if self.volume.exists():
-            logging.warn("Snapshot %s for LV already exists, need to delete first.\n" % self.snapshot_lv)
-            self.volume.remove()
+            log.warning("Snapshot %s for LV already exists, need to delete first.\n" % self.snapshot_lv)
+            await self.volume.remove()
         else:
-            logging.debug("Snapshot %s does not exist " % self.snapshot_lv)
+            log.debug("Snapshot %s does not exist " % self.snapshot_lv)
 
-        runCommand("lvcreate -s -n %s -L 1G %s/%s" % (self.snapshot_lv, self.source.volume.vg, self.source.volume.lv) )
-        logging.info("Snapshot volume %s created.\n" % self.snapshot_lv)
+        # udev is settled by backup_source() before the snapshot is mounted
+        await runCommand("lvcreate", "-s", "--noudevsync", "-y", "-n", self.snapshot_lv, "-L", "1G", f"{self.source.volume.vg}/{self.source.volume.lv}")
+        config.lv_created(self.volume.vg, self.volume.lv)
+        log.info("Snapshot volume %s created.\n" % self.snapshot_lv)
 
-    def remove(self):
-        return self.volume.remove()
+    async def remove(self):
+        return await self.volume.remove()
 
 class LVolume:
-    def __init__(self, vg, lv, options=[], raw=False):
+    __slots__ = ("vg", "lv", "options", "raw", "_mount_dir", "_device")
+
+    def __init__(self, vg, lv, options=None, raw=False):
         self.vg = vg
         self.lv = lv
-        self.options = options
+        self.options = tuple(options) if options else ()
         self.raw = raw
+        # sources are built while the global config is still being parsed, so the mount dir is resolved on first use
+        self._mount_dir = None
+        self._device = f"/dev/mapper/{vg}-{lv.replace('-', '--')}"
 
     def to_mount_dir(self):
-        return "%s/%s/%s" % (config.mounts_dir, self.vg, self.lv)
+        if self._mount_dir is None:
+            self._mount_dir = f"{config.mounts_dir}/{self.vg}/{self.lv}"
+        return self._mount_dir
         
     def to_device(self):
-        lv_escaped = self.lv.replace("-", "--")
-        return "/dev/mapper/%s-%s" % (self.vg, lv_escaped)
+        return self._device
 
     def exists(self):
-        return runCommandRetVal("lvs %s" % self.to_device()) == 0
+        return config.lv_exists(self.vg, self.lv)
 
-    def remove(self):
-        return runCommandRetVal("lvremove -y %s/%s" % (self.vg, self.lv)) == 0
+    async def remove(self):
+        removed = await runCommandRetVal("lvremove", "-y", f"{self.vg}/{self.lv}") == 0
+        if removed:
+            config.lv_removed(self.vg, self.lv)
+        return removed
 
-    def mount(self, ro=False):
+    async def mount(self, ro=False):
         if self.is_mounted():
             BackupException("Volume %s already mounted. Aborting." % self.lv)
-        if not os.path.isdir(self.to_mount_dir()):
-            os.makedirs(self.to_mount_dir(), exist_ok=True)
-        options=""
+        os.makedirs(self.to_mount_dir(), exist_ok=True)
+        options = []
         if ro:
-            options = "-o ro"
+            options = ["-o", "ro"]
         elif "xfs" in self.options:
-            options = "-o nouuid"
+            options = ["-o", "nouuid"]
         if self.raw:
-            self.map_raw()
+            await self.map_raw()
             device = self.to_device() + "1" #TODO: Assuming that VM raw disks have only one partition
         else:
             device = self.to_device() 
-        runCommand("mount %s %s %s" % (options, device, self.to_mount_dir()))
+        await runCommand("mount", *options, device, self.to_mount_dir())
 
     def is_mounted(self):
         if self.raw:
             device = self.to_device() + "1" #TODO: Assuming that VM raw disks have only one partition
         else:
             device = self.to_device() 
-        return runCommandRetVal("findmnt %s" % device ) == 0
-
-    def umount(self):
-        runCommand("umount %s" % self.to_mount_dir())
+        mounts = _mounts()
+        if any(source == device for (_, source) in mounts):
+            return True
+        # the source may be recorded under another name (e.g. /dev/dm-N), so fall back to the device number
+        try:
+            rdev = os.stat(device).st_rdev
+        except OSError:
+            return False
+        device_number = f"{os.major(rdev)}:{os.minor(rdev)}"
+        return any(number == device_number for (number, _) in mounts)
+
+    async def umount(self):
+        await runCommand("umount", self.to_mount_dir())
         if self.raw:
-            self.unmap_raw()
+            await self.unmap_raw()
+
+
+    async def map_raw(self):
+        await runCommand("kpartx", "-v", "-a", self.to_device())
 
+    async def unmap_raw(self):
+        await runCommand("kpartx", "-d", self.to_device())
 
-    def map_raw(self):
-        runCommand("kpartx -v -a %s" % self.to_device())
+def _mounts():
+    mounts = []
+    with open("/proc/self/mountinfo", 'r') as stream:
+        for line in stream:
+            # the device number is the third field, the mount source the second after the " - " separator
+            (head, tail) = line.split(" - ", 1)
+            mounts.append((head.split()[2], tail.split()[1]))
+    return mounts
 
-    def unmap_raw(self):
-        runCommand("kpartx -d %s" % self.to_device())
+def restic_env():
+    # YAML loads an all-digit password as an int, but environment values must be strings
+    return {**os.environ, "RESTIC_PASSWORD": str(config.password)}
 
-def runCommand(*args, printOutput=False):
-    result = runCommandRetVal(*args, printOutput=printOutput, ignore=False)    
+class ResticProgress:
+    def __init__(self, name):
+        self.name = name
+        self.last_status = None
+
+    def __call__(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            log.info(line)
+            return
+        message_type = message.get("message_type")
+        if message_type == "status":
+            self.status(message)
+        elif message_type == "summary":
+            log.info("%s: %d new, %d changed files, %.1f MiB added in %.0fs" % (self.name,
+                message.get("files_new", 0), message.get("files_changed", 0),
+                message.get("data_added", 0) / MIB, message.get("total_duration", 0)))
+        elif message_type == "error":
+            error = message.get("error")
+            if isinstance(error, dict):
+                error = error.get("message")
+            log.error("%s: %s" % (self.name, error or line))
+        else:
+            log.debug(line)
+
+    def status(self, message):
+        now = time.monotonic()
+        if self.last_status is not None and now - self.last_status < PROGRESS_INTERVAL:
+            return
+        self.last_status = now
+        elapsed = message.get("seconds_elapsed") or 0
+        rate = message.get("bytes_done", 0) / MIB / elapsed if elapsed else 0
+        log.info("%s: %.1f%% done, %.1f MiB/s, %ss remaining" % (self.name,
+            message.get("percent_done", 0) * 100, rate, message.get("seconds_remaining", "?")))
+
+async def runCommand(*args, printOutput=False, env=None, handleOutput=None):
+    result = await runCommandRetVal(*args, printOutput=printOutput, ignore=False, env=env, handleOutput=handleOutput)
     if (result !=0):
         raise BackupException("Execution failed: " + str(args))
 
-def runCommandRetVal(*args, printOutput=False, ignore=True):
-    logging.debug("Running command" + str(args))
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    (out, err) = p.communicate()
-    logging.log(logging.INFO if printOutput else logging.DEBUG, out.decode())
+async def runCommandRetVal(*args, printOutput=False, ignore=True, env=None, handleOutput=None):
+    log.debug("Running command" + str(args))
+    log_output_line = handleOutput or (log.info if printOutput else log.debug)
+    p = await asyncio.create_subprocess_exec(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+    async def log_output():
+        # read in chunks rather than lines, StreamReader refuses lines longer than its buffer limit
+        pending = b""
+        while True:
+            chunk = await p.stdout.read(OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                break
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                log_output_line(line.decode().rstrip())
+        if pending:
+            log_output_line(pending.decode().rstrip())
+
+    try:
+        # read stderr alongside stdout so a chatty command cannot block on a full pipe
+        (_, err) = await asyncio.gather(log_output(), p.stderr.read())
+        await p.wait()
+    finally:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
     if (err and not ignore):
-        logging.error(err.decode())
+        log.error(err.decode())
     return p.returncode
 
-def check_dependencies():
-    for cmd in [RESTIC, LVS]:
-        try:
-            returncode = runCommandRetVal(cmd)
-            if (returncode != 0):
-                raise BackupException("Please install %s" % cmd)
-        except FileNotFoundError:
+def check_dependencies(command):
+    cmds = [RESTIC, LVS]
+    if command == "backup":
+        cmds.append(UDEVADM)
+    for cmd in cmds:
+        if shutil.which(cmd) is None:
             raise BackupException("Please install %s" % cmd)
 
 def main():
@@ -220,35 +437,68 @@ def main():
     config = Config(args.config, args.prune)
     
     try:
-        check_dependencies()
+        check_dependencies(args.command)
     except BackupException as be:
-        logging.error("Dependencies are missing:")
-        logging.error(be.args[0])
+        log.error("Dependencies are missing:")
+        log.error(be.args[0])
         exit(1)
 
     switches = {
         "backup": backup,
         "cleanup": cleanup
     }
-    switches.get(args.command)()
-
-def backup():
-        for source in config.sources:
-            snapshot = Snapshot(source)
-            snapshot.create()
-            backup = Backup(source, snapshot)
-            try: 
-                backup.backup()
-            finally:
-                backup.close()
-                snapshot.remove()
+    asyncio.run(switches.get(args.command)())
 
-def cleanup():
-    backup = Backup(None, None)
+async def backup():
+    repository = Repository()
+    await repository.open()
+    try:
+        # the semaphore bounds both concurrent backups and live snapshots, so the source VGs
+        # need room for at most max_parallel snapshots at once
+        limit = asyncio.Semaphore(config.max_parallel)
+        results = await asyncio.gather(*[backup_source(source, repository, limit) for source in config.sources],
+            return_exceptions=True)
+    finally:
+        await repository.close()
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+
+async def backup_source(source, repository, limit):
+    async with limit:
+        snapshot = Snapshot(source)
+        try:
+            await snapshot.create()
+            try:
+                await runCommand(UDEVADM, "settle")
+                await Backup(source, snapshot, repository).backup()
+            finally:
+                if snapshot.volume.exists():
+                    await snapshot.remove()
+        except Exception as e:
+            log.error("backup FAILED (%s): %s" % (source.volume.lv, e))
+            raise
+
+async def cleanup():
+    repository = Repository()
+    await repository.open()
+    errors = []
     try:
-        backup.cleanup()
+        repos = set()
+        for source in config.sources or [None]:
+            backup = Backup(source, None, repository)
+            if backup.repo in repos:
+                continue
+            repos.add(backup.repo)
+            try:
+                await backup.cleanup()
+            except BackupException as e:
+                log.error("cleanup FAILED (%s): %s" % (backup.repo, e))
+                errors.append(e)
     finally:
-        backup.close()
+        await repository.close()
+    if errors:
+        raise errors[0]
 
 
 if __name__ == "__main__":